@@ -1,3 +1,4 @@
+import inspect
 import os
 import sys
 import warnings
@@ -5,12 +6,11 @@ from datetime import datetime
 import numpy as np
 import torch
 import torch.multiprocessing as mp
-from torch.utils.data import DataLoader
 
 from helpers.trainer import GANTrainer
-from helpers.get_master import find_free_port
-from helpers.ddp_training import run, GANDDPTrainer
-from helpers.dataloader import Dataloader
+from helpers.get_master import find_free_port, launched_by_torchrun
+from helpers.ddp_training import run, GANDDPTrainer, save_gan_trainer_state
+from helpers.dataloader import Dataloader, dataset_to_device, tensor_dataloader
 from helpers.initialize_gan import init_gan
 from helpers import system_inputs
 
@@ -28,6 +28,18 @@ Instructions to start the training:
 def main():
     """Main function of the training process. 
     For input help use the command 'python gan_training_main.py help' in the terminal."""
+
+    # check for GPUs via NVML so that torch.cuda.is_available() and torch.cuda.device_count() do not initialize CUDA;
+    # the main process of the distributed training then stays free of a CUDA context, which only the spawned processes need
+    os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+
+    # let the cuda caching allocator grow its segments instead of fragmenting them with the varying tensor sizes;
+    # must be set before the first cuda allocation and is inherited by the spawned ddp processes
+    if torch.cuda.is_available():
+        if tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 1):
+            os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+        else:
+            warnings.warn("Expandable segments of the CUDA allocator require PyTorch 2.1 or newer and are not used.")
     
     # create directory 'trained_models' if not exists
     if not os.path.exists('trained_models'):
@@ -42,7 +54,14 @@ def main():
 
     # Training configuration
     ddp = default_args['ddp']
-    ddp_backend = "nccl" #default_args['ddp_backend']
+    ddp_backend = default_args['ddp_backend']
+    if torch.cuda.is_available() and ddp_backend.lower() == 'gloo':
+        # gloo is much slower than nccl for the large gradient all_reduce between GPUs
+        warnings.warn("Forcing NCCL backend for CUDA DDP.")
+        ddp_backend = 'nccl'
+    elif not torch.cuda.is_available() and ddp_backend.lower() == 'nccl':
+        # nccl works only with GPUs
+        ddp_backend = 'gloo'
     checkpoint = default_args['checkpoint']
 
     # Data configuration
@@ -79,17 +98,28 @@ def main():
         'sequence_length': -1,
         'hidden_dim': default_args['hidden_dim'],  # Dimension of hidden layers in discriminator and generator
         'num_layers': default_args['num_layers'],
+        'num_heads': default_args['num_heads'],  # number of attention heads in discriminator and generator
+        'dropout': default_args['dropout'],  # dropout rate of the attention and feed-forward layers
+        'generator_embed_dim': default_args['generator_embed_dim'],  # embedding dimension of the generator; must be a multiple of num_heads
+        'discriminator_embed_dim': default_args['discriminator_embed_dim'],  # embedding dimension of the discriminator; must be a multiple of num_heads
         'latent_dim': 128,  # Dimension of the latent space
         'critic_iterations': 5,  # number of iterations of the critic per generator iteration for Wasserstein GAN
+        'grad_accum_steps': default_args['grad_accum_steps'],  # number of micro-batches per batch for gradient accumulation
+        'num_workers': default_args['num_workers'],  # number of worker processes of the DataLoader
+        'activation_compression': default_args['activation_compression'],  # compress the activations of the discriminator with GACT
         'lambda_gp': 10,  # Gradient penalty lambda for Wasserstein GAN-GP
         'device': torch.device("cuda" if torch.cuda.is_available() else "cpu") if not ddp else torch.device("cpu"), 
-        'world_size': torch.cuda.device_count() if torch.cuda.is_available() else mp.cpu_count(),  # number of processes for distributed training
+        'world_size': int(os.environ['WORLD_SIZE']) if launched_by_torchrun() else torch.cuda.device_count() if torch.cuda.is_available() else mp.cpu_count(),  # number of processes for distributed training
+        'ddp_bucket_cap_mb': 25,  # size of the gradient buckets which are all-reduced together in distributed training
+        'ddp_grad_as_view': True,  # gradients are views into the all-reduce buckets instead of separate copies
         'kw_channel': default_args['kw_channel'],
         'norm_data': norm_data,
         'std_data': std_data,
         'diff_data': diff_data,
         'seed': default_args['seed'],
         'save_name': default_args['save_name'],
+        'amp': default_args['amp'],  # mixed precision and TF32 on GPUs
+        'compile': default_args['compile'],  # compile the generator and the gradient penalty with torch.compile
         'history': None,
     }
     
@@ -100,6 +130,9 @@ def main():
         torch.cuda.manual_seed(opt['seed'])               
         torch.cuda.manual_seed_all(opt['seed'])           
         torch.backends.cudnn.deterministic = True  
+    else:
+        # let cudnn pick the fastest algorithms if the training does not need to be reproducible
+        torch.backends.cudnn.benchmark = True
     
     # Load dataset as tensor
     dataloader = Dataloader(default_args['data'],
@@ -113,10 +146,12 @@ def main():
 
     opt['channel_names'] = dataloader.channels
     opt['n_channels'] = dataset.shape[-1]
-    opt['sequence_length'] = dataset.shape[1] - dataloader.labels.shape[1]
+    opt['sequence_length'] = dataset.shape[1] - dataloader.n_labels
     opt['n_samples'] = dataset.shape[0]
 
-    ae_dict = torch.load(opt['autoencoder'], map_location=torch.device('cpu')) if opt['autoencoder'] != '' else []
+    # only the configuration of the autoencoder is needed here; memory-map the file if supported so that its tensors are not read
+    load_kwargs = {'mmap': True} if 'mmap' in inspect.signature(torch.load).parameters else {}
+    ae_dict = torch.load(opt['autoencoder'], map_location=torch.device('cpu'), **load_kwargs) if opt['autoencoder'] != '' else []
     # check if generated sequence is a multiple of patch size   
     encoded_sequence = False
     def pad_warning(sequence_length, encoded_sequence=False):
@@ -134,6 +169,8 @@ def main():
         generated_seq_length = opt['sequence_length']
     if generated_seq_length % default_args['patch_size'] != 0:
         pad_warning(generated_seq_length, encoded_sequence)
+    # init_gan loads the autoencoder again
+    del ae_dict
         
     opt['latent_dim_in'] = opt['latent_dim'] + opt['n_conditions']
     opt['channel_in_disc'] = opt['n_channels'] + opt['n_conditions']
@@ -160,11 +197,13 @@ def main():
     if default_args['checkpoint'] != '':
         
         # load checkpoint
-        model_dict = torch.load(default_args['checkpoint'])
+        model_dict = torch.load(default_args['checkpoint'], map_location=torch.device('cpu'))
 
         # update history
         for key in history.keys():
-            history[key] = model_dict['configuration']['history'][key] + history[key]
+            # options which were added after the checkpoint was saved are missing in its history
+            if key in model_dict['configuration']['history']:
+                history[key] = model_dict['configuration']['history'][key] + history[key]
 
     opt['history'] = history
 
@@ -180,9 +219,18 @@ def main():
         trainer = GANDDPTrainer(generator, discriminator, opt)
         if default_args['checkpoint'] != '':
             trainer.load_checkpoint(default_args['checkpoint'])
-        mp.spawn(run,
-                 args=(opt['world_size'], find_free_port(), ddp_backend, trainer, opt),
-                 nprocs=opt['world_size'], join=True)
+        if launched_by_torchrun():
+            # torchrun started this script once per process; e.g. torchrun --nproc_per_node=4 gan_training_main.py ddp
+            run(int(os.environ['LOCAL_RANK']), opt['world_size'], None, ddp_backend, trainer, opt)
+        else:
+            # serialize the trainer state once; each spawned process rebuilds the trainer from this file
+            trainer_state = save_gan_trainer_state(trainer)
+            try:
+                mp.spawn(run,
+                         args=(opt['world_size'], find_free_port(), ddp_backend, trainer_state, opt),
+                         nprocs=opt['world_size'], join=True)
+            finally:
+                os.remove(trainer_state)
         
         print("GAN training finished.")
         
@@ -190,7 +238,10 @@ def main():
         trainer = GANTrainer(generator, discriminator, opt)
         if default_args['checkpoint'] != '':
             trainer.load_checkpoint(default_args['checkpoint'])
-        dataset = DataLoader(dataset, batch_size=trainer.batch_size, shuffle=True, pin_memory=True)
+        # keep the dataset on the gpu if it fits; pinning and workers are only used for a dataset on the cpu
+        dataset = dataset_to_device(dataset, trainer.device)
+        # a compiled generator gets batches of one shape only
+        dataset = tensor_dataloader(dataset, trainer.batch_size, shuffle=True, num_workers=opt['num_workers'], drop_last=trainer.compile)
         gen_samples = trainer.training(dataset)
 
         # save final models, optimizer states, generated samples, losses and configuration as final result
@@ -110,6 +110,11 @@ def main():
                                 hidden_dim=state_dict['configuration']['hidden_dim'],
                                 num_layers=state_dict['configuration']['num_layers'],
                                 patch_size=state_dict['configuration']['patch_size'],
+                                # models saved before these options were added use the defaults of init_gan
+                                num_heads=state_dict['configuration'].get('num_heads', 5),
+                                dropout=state_dict['configuration'].get('dropout', 0.5),
+                                generator_embed_dim=state_dict['configuration'].get('generator_embed_dim', 10),
+                                discriminator_embed_dim=state_dict['configuration'].get('discriminator_embed_dim', 50),
                                 autoencoder=state_dict['configuration']['autoencoder'],
                                 )
         generator.eval()
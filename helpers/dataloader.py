@@ -3,6 +3,7 @@ import warnings
 import numpy as np
 import pandas as pd
 import torch
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
 from typing import Union, List
 
 from matplotlib import pyplot as plt
@@ -46,6 +47,7 @@ class Dataloader:
             # Get labels and data
             dataset = torch.FloatTensor(df.to_numpy()[:, n_col_data])
             n_labels = len(kw_conditions) if kw_conditions[0] != '' else 0
+            self.n_labels = n_labels  # number of label columns in front of the time steps of the dataset
             labels = torch.zeros((dataset.shape[0], n_labels))
             if n_labels:
                 for i, l in enumerate(kw_conditions):
@@ -196,3 +198,39 @@ class Dataloader:
         if self.dataset is None:
             raise ValueError("Dataset is None. Please load data first.")
         pd.DataFrame(self.dataset.detach().cpu().numpy()).to_csv(path)
+
+
+def dataset_to_device(dataset: torch.Tensor, device, max_memory_fraction=0.5):
+    """Move the dataset to the given cuda device if it takes up less than max_memory_fraction of the free device memory.
+    A device-resident dataset saves the host-to-device copy of every batch. Otherwise, the dataset stays on the cpu."""
+    device = torch.device(device)
+    if device.type != 'cuda' or not torch.cuda.is_available():
+        return dataset
+    free_memory, _ = torch.cuda.mem_get_info(device)
+    if dataset.element_size() * dataset.nelement() > max_memory_fraction * free_memory:
+        return dataset
+    return dataset.to(device)
+
+
+def dataloader_kwargs(dataset: torch.Tensor, num_workers=0):
+    """Keyword arguments for a torch DataLoader over the given dataset tensor.
+    Worker processes and pinned memory are only used for a dataset on the cpu. For a dataset in RAM, num_workers=0 is
+    usually fastest; with workers, they are kept alive between epochs and prefetch several batches each."""
+    if dataset.is_cuda:
+        return {'num_workers': 0, 'pin_memory': False}
+    kwargs = {'num_workers': num_workers, 'pin_memory': torch.cuda.is_available()}
+    if num_workers > 0:
+        kwargs.update({'persistent_workers': True, 'prefetch_factor': 4})
+    return kwargs
+
+
+def tensor_dataloader(dataset: torch.Tensor, batch_size, shuffle=True, num_workers=0, drop_last=False):
+    """torch DataLoader which gathers each batch from the dataset tensor with one indexing operation.
+    The default DataLoader indexes the samples one by one and stacks them, which is slow for large batches.
+    With drop_last, all batches have the same shape, which compiled models need to avoid recompiling for the last batch;
+    it is ignored if the dataset is smaller than one batch."""
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    drop_last = drop_last and len(dataset) >= batch_size
+    # with batch_size=None the DataLoader passes the index lists of the batch sampler directly to the dataset
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=drop_last), batch_size=None,
+                      **dataloader_kwargs(dataset, num_workers))
@@ -1,15 +1,23 @@
+import inspect
 import os
+import queue
+import signal
+import tempfile
+import warnings
+from collections import namedtuple
 from datetime import datetime, timedelta
 import numpy as np
 
 import torch
 
 import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import DataLoader
 
 import helpers.trainer as trainer
-from helpers.dataloader import Dataloader
+from helpers.dataloader import Dataloader, dataset_to_device, tensor_dataloader
+from helpers.get_master import launched_by_torchrun
+from helpers.initialize_gan import init_gan
 
 
 class GANDDPTrainer(trainer.GANTrainer):
@@ -23,48 +31,140 @@ class GANDDPTrainer(trainer.GANTrainer):
         super().__init__(generator, discriminator, opt)
 
         self.world_size = opt['world_size'] if 'world_size' in opt else 1
+        self.ddp_bucket_cap_mb = opt['ddp_bucket_cap_mb'] if 'ddp_bucket_cap_mb' in opt else 25
+        self.ddp_grad_as_view = opt['ddp_grad_as_view'] if 'ddp_grad_as_view' in opt else True
+
+        # checkpoints are staged in shared memory and written by a background process, which is started in
+        # set_ddp_framework since it cannot be pickled by mp.spawn
+        self._checkpoint_buffers = {}  # one flat shared memory buffer per dtype
+        self._checkpoint_process = None
+        self._checkpoint_queue = None
+        self._checkpoint_done = None
+        self._checkpoint_pending = None  # layout of the staged state and path of the checkpoint which is being written
 
     # ---------------------
     #  DDP-specific modifications
     # ---------------------
 
     def save_checkpoint(self, path_checkpoint=None, samples=None, generator=None, discriminator=None, update_history=False):
-        if self.rank == 0:
-            super().save_checkpoint(path_checkpoint, samples, generator=self.generator.module, discriminator=self.discriminator.module, update_history=update_history)
+        if self.global_rank == 0:
+            super().save_checkpoint(path_checkpoint, samples, generator=self._gen_module, discriminator=self._disc_module, update_history=update_history)
         # dist.barrier()
 
+    def _no_sync(self, model):
+        return model.no_sync()
+
+    def _write_checkpoint(self, state_dict, path_checkpoint):
+        # the shared memory buffers are reused, so the previous checkpoint has to be written before staging the next one
+        self.wait_for_checkpoint()
+
+        if not self._checkpoint_writer_alive():
+            # the writer process is gone (e.g. killed); save synchronously instead
+            torch.save(state_dict, path_checkpoint)
+            return
+
+        # copy the states into shared memory; the slow write to the disk is done by the writer process
+        layout = _stage_in_shared_memory(state_dict, self._checkpoint_buffers)
+        self._checkpoint_queue.put((layout, self._checkpoint_buffers, path_checkpoint))
+        self._checkpoint_pending = (layout, path_checkpoint)
+
+    def wait_for_checkpoint(self):
+        """blocks until the checkpoint which is written in the background is saved.
+        If the writer process stopped before, the checkpoint is saved synchronously."""
+        if self._checkpoint_pending is None:
+            return
+        layout, path_checkpoint = self._checkpoint_pending
+        while True:
+            try:
+                error = self._checkpoint_done.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self._checkpoint_writer_alive():
+                    warnings.warn(f"The checkpoint writer process stopped. Saving checkpoint {path_checkpoint} synchronously.")
+                    torch.save(_unstage_from_shared_memory(layout, self._checkpoint_buffers), path_checkpoint)
+                    error = None
+                    break
+        self._checkpoint_pending = None
+        if error is not None:
+            raise RuntimeError(error)
+
+    def _checkpoint_writer_alive(self):
+        return self._checkpoint_process is not None and self._checkpoint_process.is_alive()
+
+    def start_checkpoint_writer(self):
+        """starts the background process which writes the checkpoints to the disk"""
+        ctx = mp.get_context('spawn')
+        self._checkpoint_queue = ctx.SimpleQueue()
+        # a queue with timeouts, so that waiting for a checkpoint can notice a dead writer process
+        self._checkpoint_done = ctx.Queue()
+        self._checkpoint_process = ctx.Process(target=_checkpoint_writer, args=(self._checkpoint_queue, self._checkpoint_done), daemon=True)
+        self._checkpoint_process.start()
+
+    def stop_checkpoint_writer(self):
+        """waits for the last checkpoint and shuts the writer process down"""
+        if self._checkpoint_process is not None:
+            self.wait_for_checkpoint()
+            if self._checkpoint_writer_alive():
+                self._checkpoint_queue.put(None)
+            self._checkpoint_process.join()
+            self._checkpoint_process = None
+
     def print_log(self, current_epoch, d_loss, g_loss):
         # if self.rank == 0:
         # average the loss across all processes before printing
         reduce_tensor = torch.tensor([d_loss, g_loss], dtype=torch.float32, device=self.device)
-        dist.all_reduce(reduce_tensor, op=dist.ReduceOp.SUM)
-        reduce_tensor /= self.world_size
+        _all_reduce_mean(reduce_tensor, self.world_size)
 
         super().print_log(current_epoch, reduce_tensor[0], reduce_tensor[1])
 
     def manage_checkpoints(self, path_checkpoint: str, checkpoint_files: list, generator=None, discriminator=None, samples=None, update_history=False):
-        if self.rank == 0:
-            super().manage_checkpoints(path_checkpoint, checkpoint_files, generator=self.generator.module, discriminator=self.discriminator.module, samples=samples, update_history=update_history)
+        if self.global_rank == 0:
+            super().manage_checkpoints(path_checkpoint, checkpoint_files, generator=self._gen_module, discriminator=self._disc_module, samples=samples, update_history=update_history)
 
     def set_device(self, rank):
+        # rank is the local rank which selects the device; under torchrun it differs from the global rank on nodes
+        # other than the first one, so the main process is determined by the global rank
         self.rank = rank
+        self.global_rank = dist.get_rank()
         self.device = torch.device(f'cuda:{rank}' if torch.cuda.is_available() else f'cpu:{rank}')
 
     def set_ddp_framework(self):
+        # only the main process writes checkpoints
+        if self.global_rank == 0:
+            self.start_checkpoint_writer()
+
         # set ddp generator and discriminator
         self.generator.to(self.rank)
         self.discriminator.to(self.rank)
-        self.generator = DDP(self.generator, device_ids=[self.rank], find_unused_parameters=False) #TODO: We suppressed a warning that not all outputs were being used by adding the find_unused... argument. Should check further to see if this is here appropriate.
-        self.discriminator = DDP(self.discriminator, device_ids=[self.rank], find_unused_parameters=False) #TODO: We suppressed a warning that not all outputs were being used by adding the find_unused... argument. Should check further to see if this is here appropriate.
+        # gradients are views into the communication buckets to avoid copying them;
+        # the models have no buffers which would need to be broadcast in every forward pass
+        ddp_kwargs = {'bucket_cap_mb': self.ddp_bucket_cap_mb, 'gradient_as_bucket_view': self.ddp_grad_as_view, 'broadcast_buffers': False}
+        # the architecture of the generator does not change during training; a static graph lets DDP reuse the
+        # bucket order of the first iteration (not for models using no_sync since static_graph breaks it, i.e. for
+        # the discriminator and for the generator with gradient accumulation)
+        self.generator = DDP(self.generator, device_ids=[self.rank], find_unused_parameters=False, static_graph=self.grad_accum_steps == 1, **ddp_kwargs) #TODO: We suppressed a warning that not all outputs were being used by adding the find_unused... argument. Should check further to see if this is here appropriate.
+        self.discriminator = DDP(self.discriminator, device_ids=[self.rank], find_unused_parameters=False, **ddp_kwargs) #TODO: We suppressed a warning that not all outputs were being used by adding the find_unused... argument. Should check further to see if this is here appropriate.
+
+        # keep references to the wrapped modules for checkpointing
+        self._gen_module = self.generator.module
+        self._disc_module = self.discriminator.module
 
-        # safe optimizer state_dicts for later use
+        # safe optimizer state_dicts, init new ddp optimizer and load state_dicts
+        # the old optimizers are deleted first so that their states are not kept alongside the new ones
         g_opt_state = self.generator_optimizer.state_dict()
         d_opt_state = self.discriminator_optimizer.state_dict()
+        del self.generator_optimizer, self.discriminator_optimizer
 
-        self.generator_optimizer = torch.optim.Adam(self.generator.parameters(),
-                                                    lr=self.g_lr, betas=(self.b1, self.b2))
-        self.discriminator_optimizer = torch.optim.Adam(self.discriminator.parameters(),
-                                                        lr=self.d_lr, betas=(self.b1, self.b2))
+        self.generator_optimizer = trainer.adam_optimizer(self.generator.parameters(),
+                                                          lr=self.g_lr, betas=(self.b1, self.b2))
+        self.discriminator_optimizer = trainer.adam_optimizer(self.discriminator.parameters(),
+                                                              lr=self.d_lr, betas=(self.b1, self.b2))
+        self.generator_optimizer.load_state_dict(g_opt_state)
+        self.discriminator_optimizer.load_state_dict(d_opt_state)
+        del g_opt_state, d_opt_state
+
+        # mixed precision depends on the device of the process
+        self.set_amp()
 
 
 class AEDDPTrainer(trainer.AETrainer):
@@ -84,23 +184,25 @@ class AEDDPTrainer(trainer.AETrainer):
     # ---------------------
 
     def save_checkpoint(self, path_checkpoint=None, model=None, update_history=False, samples=None):
-        if self.rank == 0:
+        if self.global_rank == 0:
             super().save_checkpoint(path_checkpoint=path_checkpoint, model=model, update_history=update_history, samples=samples)
         # dist.barrier()
 
     def print_log(self, current_epoch, train_loss, test_loss):
         reduce_tensor = torch.tensor([train_loss, test_loss], dtype=torch.float32, device=self.device)
-        dist.all_reduce(reduce_tensor, op=dist.ReduceOp.SUM)
-        reduce_tensor /= self.world_size
+        _all_reduce_mean(reduce_tensor, self.world_size)
 
         super().print_log(current_epoch, reduce_tensor[0], reduce_tensor[1])
 
     def manage_checkpoints(self, path_checkpoint: str, checkpoint_files: list, model=None, update_history=False, samples=None):
-        if self.rank == 0:
-            super().manage_checkpoints(path_checkpoint, checkpoint_files, model=self.model.module, update_history=update_history, samples=samples)
+        if self.global_rank == 0:
+            super().manage_checkpoints(path_checkpoint, checkpoint_files, model=self._model_module, update_history=update_history, samples=samples)
 
     def set_device(self, rank):
+        # rank is the local rank which selects the device; under torchrun it differs from the global rank on nodes
+        # other than the first one, so the main process is determined by the global rank
         self.rank = rank
+        self.global_rank = dist.get_rank()
         self.device = torch.device(f'cuda:{rank}' if torch.cuda.is_available() else f'cpu:{rank}')
 
     def set_ddp_framework(self):
@@ -109,28 +211,145 @@ class AEDDPTrainer(trainer.AETrainer):
         self.model.device = self.device
         self.model = DDP(self.model, device_ids=[self.rank], find_unused_parameters=True) #TODO: We suppressed a warning that not all outputs were being used by adding the find_unused... argument. Should check further to see if this is here appropriate.
 
+        # keep a reference to the wrapped module for checkpointing
+        self._model_module = self.model.module
+
         # safe optimizer state_dicts, init new ddp optimizer and load state_dicts
         opt_state = self.optimizer.state_dict()
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.learning_rate)
 
 
+def _all_reduce_mean(tensor, world_size):
+    """averages the tensor across all processes in place; NCCL averages within the collective,
+    gloo does not support ReduceOp.AVG, so the sum is divided by the number of processes"""
+    if dist.get_backend() == 'nccl' and hasattr(dist.ReduceOp, 'AVG'):
+        dist.all_reduce(tensor, op=dist.ReduceOp.AVG)
+    else:
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+        tensor /= world_size
+
+
+# position of a staged tensor in the flat shared memory buffer of its dtype
+_StagedTensor = namedtuple('_StagedTensor', ['dtype', 'offset', 'shape'])
+
+
+def _stage_in_shared_memory(state_dict, buffers):
+    """copies all tensors of the given (nested) state into one flat shared memory buffer per dtype and returns the
+    layout of the state, in which the tensors are replaced by their positions in the buffers.
+    Passing a few flat buffers to the writer process instead of every tensor keeps the number of file descriptors low.
+    The buffers are kept in buffers and reused as long as they are large enough."""
+    tensors = []
+    sizes = {}
+    layout = _tensor_layout(state_dict, tensors, sizes)
+    for dtype, size in sizes.items():
+        if dtype not in buffers or buffers[dtype].numel() < size:
+            buffers[dtype] = torch.empty(size, dtype=dtype).share_memory_()
+    for tensor, staged in tensors:
+        buffers[staged.dtype][staged.offset:staged.offset + tensor.numel()].view(staged.shape).copy_(tensor.detach())
+    return layout
+
+
+def _tensor_layout(obj, tensors, sizes):
+    # replaces the tensors by their positions in the flat buffers, which are counted in sizes
+    if isinstance(obj, torch.Tensor):
+        staged = _StagedTensor(obj.dtype, sizes.get(obj.dtype, 0), obj.shape)
+        sizes[obj.dtype] = staged.offset + obj.numel()
+        tensors.append((obj, staged))
+        return staged
+    elif isinstance(obj, dict):
+        return {k: _tensor_layout(v, tensors, sizes) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_tensor_layout(v, tensors, sizes) for v in obj)
+    return obj
+
+
+def _unstage_from_shared_memory(layout, buffers):
+    """rebuilds the state staged by _stage_in_shared_memory. The tensors are copied out of the buffers,
+    so that each of them is saved with its own storage as by a direct torch.save of the state."""
+    if isinstance(layout, _StagedTensor):
+        return buffers[layout.dtype][layout.offset:layout.offset + layout.shape.numel()].view(layout.shape).clone()
+    elif isinstance(layout, dict):
+        return {k: _unstage_from_shared_memory(v, buffers) for k, v in layout.items()}
+    elif isinstance(layout, (list, tuple)):
+        return type(layout)(_unstage_from_shared_memory(v, buffers) for v in layout)
+    return layout
+
+
+def _checkpoint_writer(checkpoints, done):
+    """background process which saves the checkpoints staged in shared memory by the training process"""
+    # Ctrl+C reaches all processes of the foreground group; the training process handles it and still saves its
+    # final checkpoints through this process, which therefore must not stop on SIGINT
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        item = checkpoints.get()
+        if item is None:
+            break
+        layout, buffers, path_checkpoint = item
+        try:
+            torch.save(_unstage_from_shared_memory(layout, buffers), path_checkpoint)
+            done.put(None)
+        except Exception as error:
+            done.put(f"Saving checkpoint {path_checkpoint} failed: {error}")
+        del item, layout, buffers
+
+
+def save_gan_trainer_state(trainer_ddp):
+    """saves the model and optimizer states of a GANDDPTrainer once to a temporary file, which the spawned processes
+    load themselves instead of receiving the whole trainer pickled by mp.spawn; returns the path of the file"""
+    fd, path = tempfile.mkstemp(suffix='.pt')
+    os.close(fd)
+    torch.save({
+        'generator': trainer_ddp.generator.state_dict(),
+        'discriminator': trainer_ddp.discriminator.state_dict(),
+        'generator_optimizer': trainer_ddp.generator_optimizer.state_dict(),
+        'discriminator_optimizer': trainer_ddp.discriminator_optimizer.state_dict(),
+    }, path)
+    return path
+
+
+def _load_gan_trainer(path, opt):
+    """rebuilds the GANDDPTrainer from the opt dict and the states saved by save_gan_trainer_state"""
+    # memory-map the file if supported so that the tensors are only read when copied into the models
+    load_kwargs = {'mmap': True} if 'mmap' in inspect.signature(torch.load).parameters else {}
+    state_dict = torch.load(path, map_location='cpu', **load_kwargs)
+
+    generator, discriminator = init_gan(**opt)
+    generator.load_state_dict(state_dict['generator'])
+    discriminator.load_state_dict(state_dict['discriminator'])
+    trainer_ddp = GANDDPTrainer(generator, discriminator, opt)
+    trainer_ddp.generator_optimizer.load_state_dict(state_dict['generator_optimizer'])
+    trainer_ddp.discriminator_optimizer.load_state_dict(state_dict['discriminator_optimizer'])
+    return trainer_ddp
+
+
 def run(rank, world_size, master_port, backend, trainer_ddp, opt):
     try:
         _setup(rank, world_size, master_port, backend)
+        if isinstance(trainer_ddp, str):
+            # the main process saved the trainer state to this file (see save_gan_trainer_state)
+            trainer_ddp = _load_gan_trainer(trainer_ddp, opt)
         trainer_ddp = _setup_trainer(rank, trainer_ddp)
         _ddp_training(trainer_ddp, opt)
         dist.destroy_process_group()
     except Exception as error:
         ValueError(f"Error in DDP training: {error}")
         dist.destroy_process_group()
+    finally:
+        # a checkpoint which is being written is finished before the daemonic writer process ends with this process
+        if isinstance(trainer_ddp, GANDDPTrainer):
+            trainer_ddp.stop_checkpoint_writer()
 
 
 def _setup(rank, world_size, master_port, backend):
-    os.environ['MASTER_ADDR'] = 'localhost'
-    os.environ['MASTER_PORT'] = str(master_port)
+    if launched_by_torchrun():
+        # torchrun already performed the rendezvous; rank is the local rank of the process on its node
+        rank = int(os.environ['RANK'])
+    else:
+        os.environ['MASTER_ADDR'] = 'localhost'
+        os.environ['MASTER_PORT'] = str(master_port)
 
-    # create default process group
-    dist.init_process_group(backend, rank=rank, world_size=world_size, timeout=timedelta(seconds=30))
+    # create default process group; the initialization of nccl can take a while on many processes
+    dist.init_process_group(backend, rank=rank, world_size=world_size, timeout=timedelta(minutes=30))
 
 
 def _setup_trainer(rank, trainer_ddp):
@@ -144,6 +363,10 @@ def _setup_trainer(rank, trainer_ddp):
     return trainer_ddp
 
 def _ddp_training(trainer_ddp, opt):
+    # the cudnn settings of the main process are not inherited by the spawned processes
+    if 'seed' in opt and opt['seed'] is None:
+        torch.backends.cudnn.benchmark = True
+
     # load data
     if 'conditions' not in opt:
         opt['conditions'] = ['']
@@ -166,7 +389,9 @@ def _ddp_training(trainer_ddp, opt):
         raise ValueError(f"Trainer type {type(trainer_ddp)} not supported.")
     
     dataset = dataloader.get_data()
-    opt['sequence_length'] = dataset.shape[2] - dataloader.labels.shape[2]
+    opt['sequence_length'] = dataset.shape[1] - dataloader.n_labels
+
+    num_workers = opt['num_workers'] if 'num_workers' in opt else 0
 
     if trainer_ddp.batch_size > len(dataset):
         raise ValueError(f"Batch size {trainer_ddp.batch_size} is larger than the partition size {len(dataset)}.")
@@ -175,21 +400,25 @@ def _ddp_training(trainer_ddp, opt):
     if isinstance(trainer_ddp, GANDDPTrainer):
         path = 'trained_models'
         model_prefix = 'gan'
-        dataset = DataLoader(dataset, batch_size=trainer_ddp.batch_size, shuffle=True)
-        gen_samples = trainer_ddp.training(dataset)
+        # keep the dataset on the gpu of the process if it fits
+        dataset = dataset_to_device(dataset, trainer_ddp.device)
+        # a compiled generator gets batches of one shape only
+        dataset = tensor_dataloader(dataset, trainer_ddp.batch_size, shuffle=True, num_workers=num_workers, drop_last=trainer_ddp.compile)
+        # only the main process saves the generated samples
+        gen_samples = trainer_ddp.training(dataset, return_samples=trainer_ddp.global_rank == 0)
     elif isinstance(trainer_ddp, AEDDPTrainer):
         path = 'trained_ae'
         model_prefix = 'ae'
         train_data = dataset[:int(len(dataset) * opt['train_ratio'])]
         test_data = dataset[int(len(dataset) * opt['train_ratio']):]
-        train_data = DataLoader(train_data, batch_size=trainer_ddp.batch_size, shuffle=True)
-        test_data = DataLoader(test_data, batch_size=trainer_ddp.batch_size, shuffle=True)
+        train_data = tensor_dataloader(train_data, trainer_ddp.batch_size, shuffle=True, num_workers=num_workers)
+        test_data = tensor_dataloader(test_data, trainer_ddp.batch_size, shuffle=True, num_workers=num_workers)
         trainer_ddp.training(train_data, test_data)
     else:
         raise ValueError(f"Trainer type {type(trainer_ddp)} not supported.")
 
     # save checkpoint
-    if trainer_ddp.rank == 0:
+    if trainer_ddp.global_rank == 0:
 
         # save final models, optimizer states, generated samples, losses and configuration as final result
         path = 'trained_models'
@@ -204,6 +433,7 @@ def _ddp_training(trainer_ddp, opt):
 
         if isinstance(trainer_ddp, GANDDPTrainer):
             trainer_ddp.save_checkpoint(path_checkpoint=os.path.join(path, filename), samples=gen_samples)
+            trainer_ddp.stop_checkpoint_writer()
         elif isinstance(trainer_ddp, AEDDPTrainer):
             samples = []
             for batch in test_data:
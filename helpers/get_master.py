@@ -1,3 +1,4 @@
+import os
 import socket
 from contextlib import closing
 
@@ -9,3 +10,9 @@ def find_free_port():
         s.bind(('', 0))
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         return str(s.getsockname()[1])
+
+
+def launched_by_torchrun():
+    """True if the script was started by torchrun, which runs one process per GPU and
+    provides the rendezvous (MASTER_ADDR, MASTER_PORT, RANK, WORLD_SIZE, LOCAL_RANK) via environment variables"""
+    return all(key in os.environ for key in ('RANK', 'LOCAL_RANK', 'WORLD_SIZE'))
@@ -1,3 +1,6 @@
+import inspect
+from contextlib import nullcontext
+
 import torch
 from torch.nn.modules.utils import consume_prefix_in_state_dict_if_present
 
@@ -5,9 +8,16 @@ from nn_architecture.ae_networks import TransformerAutoencoder, TransformerDoubl
 from nn_architecture.models import TTSGenerator, TTSDiscriminator, DecoderGenerator, EncoderDiscriminator
 
 
+# constructor of each architecture, the mapping of its arguments to the inputs of build_architecture and fixed arguments
 gan_architectures = {
-        'TTSGenerator': lambda seq_len, hidden_dim, patch_size, channels, latent_dim, num_layers, num_heads, **kwargs: TTSGenerator(seq_len, patch_size, channels, 1, latent_dim, 10, num_layers, num_heads, 0.5, 0.5),
-        'TTSDiscriminator': lambda channels, hidden_dim, patch_size, seq_len, num_layers, **kwargs: TTSDiscriminator(channels, patch_size, 50, seq_len, num_layers, 1),
+        'TTSGenerator': (TTSGenerator,
+                         {'seq_len': 'seq_len', 'patch_size': 'patch_size', 'channels': 'channels', 'latent_dim': 'latent_dim', 'embed_dim': 'embed_dim',
+                          'depth': 'num_layers', 'num_heads': 'num_heads', 'forward_drop_rate': 'dropout', 'attn_drop_rate': 'dropout'},
+                         {'num_classes': 1}),
+        'TTSDiscriminator': (TTSDiscriminator,
+                             {'in_channels': 'channels', 'patch_size': 'patch_size', 'emb_size': 'embed_dim', 'seq_length': 'seq_len', 'depth': 'num_layers',
+                              'num_heads': 'num_heads', 'drop_p': 'dropout', 'forward_drop_p': 'dropout'},
+                             {'n_classes': 1}),
     }
 
 gan_types = {
@@ -15,6 +25,12 @@ gan_types = {
     }
 
 
+def build_architecture(name, **kwargs):
+    """initializes the architecture with the given name from the inputs it uses; unused inputs are ignored"""
+    architecture, arg_names, fixed_args = gan_architectures[name]
+    return architecture(**{arg: kwargs[key] for arg, key in arg_names.items()}, **fixed_args)
+
+
 def init_gan(latent_dim_in, 
              channel_in_disc, 
              n_channels, 
@@ -27,31 +43,41 @@ def init_gan(latent_dim_in,
              input_sequence_length=0, 
              patch_size=-1, 
              autoencoder='',
+             num_heads=5,
+             dropout=0.5,
+             generator_embed_dim=10,
+             discriminator_embed_dim=50,
              **kwargs,
              ):
+    for embed_dim in (generator_embed_dim, discriminator_embed_dim):
+        if embed_dim % num_heads != 0:
+            raise ValueError(f"Embedding dimension ({embed_dim}) must be a multiple of the number of heads ({num_heads}).")
+
     if autoencoder == '':
         # no autoencoder defined -> use transformer GAN
-        generator = gan_architectures[gan_types['tts'][0]](
+        generator = build_architecture(gan_types['tts'][0],
             latent_dim=latent_dim_in,
             channels=n_channels,
             seq_len=sequence_length_generated,
             hidden_dim=hidden_dim,
+            embed_dim=generator_embed_dim,
             num_layers=num_layers,
-            dropout=0.1,
+            dropout=dropout,
             activation=activation,
-            num_heads=4,
+            num_heads=num_heads,
 
             # additional TTSGenerator inputs: patch_size
             patch_size=patch_size,
         )
 
-        discriminator = gan_architectures[gan_types['tts'][1]](
+        discriminator = build_architecture(gan_types['tts'][1],
             channels=channel_in_disc,
             hidden_dim=hidden_dim,
+            embed_dim=discriminator_embed_dim,
             num_layers=num_layers,
-            dropout=0.1,
+            dropout=dropout,
             seq_len=sequence_length_generated,
-            num_heads=4,
+            num_heads=num_heads,
 
             # additional TTSDiscriminator inputs: patch_size
             patch_size=patch_size,
@@ -60,43 +86,55 @@ def init_gan(latent_dim_in,
         # initialize an autoencoder-GAN
 
         # initialize the autoencoder
-        ae_dict = torch.load(autoencoder, map_location=torch.device('cpu'))
-        if ae_dict['configuration']['target'] == 'channels':
-            ae_dict['configuration']['target'] = TransformerAutoencoder.TARGET_CHANNELS
-            autoencoder = TransformerAutoencoder(**ae_dict['configuration']).to(device)
-        elif ae_dict['configuration']['target'] == 'time':
-            ae_dict['configuration']['target'] = TransformerAutoencoder.TARGET_TIMESERIES
-            autoencoder = TransformerAutoencoder(**ae_dict['configuration']).to(device)
-        elif ae_dict['configuration']['target'] == 'full':
-            autoencoder = TransformerDoubleAutoencoder(**ae_dict['configuration'], training_level=2).to(device)
-            autoencoder.model_1 = TransformerDoubleAutoencoder(**ae_dict['configuration'], training_level=1).to(device)
-            autoencoder.model_1.eval()
-        else:
-            raise ValueError(f"Autoencoder class {ae_dict['configuration']['model_class']} not recognized.")
-        consume_prefix_in_state_dict_if_present(ae_dict['model'], 'module.')
-        autoencoder.load_state_dict(ae_dict['model'])
-        # freeze the autoencoder
-        for param in autoencoder.parameters():
-            param.requires_grad = False
-        autoencoder.eval()
+        # memory-map the file if supported so that the tensors are only read when loaded into the autoencoder
+        load_kwargs = {'mmap': True} if 'mmap' in inspect.signature(torch.load).parameters else {}
+        ae_dict = torch.load(autoencoder, map_location=torch.device('cpu'), **load_kwargs)
+        # take over the loaded tensors instead of copying them into the initialized parameters if supported;
+        # the autoencoder is then built on the meta device without allocating and initializing its parameters
+        assign_kwargs = {'assign': True} if 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters else {}
+        with torch.device('meta') if assign_kwargs else nullcontext():
+            if ae_dict['configuration']['target'] == 'channels':
+                ae_dict['configuration']['target'] = TransformerAutoencoder.TARGET_CHANNELS
+                autoencoder = TransformerAutoencoder(**ae_dict['configuration'])
+            elif ae_dict['configuration']['target'] == 'time':
+                ae_dict['configuration']['target'] = TransformerAutoencoder.TARGET_TIMESERIES
+                autoencoder = TransformerAutoencoder(**ae_dict['configuration'])
+            elif ae_dict['configuration']['target'] == 'full':
+                autoencoder = TransformerDoubleAutoencoder(**ae_dict['configuration'], training_level=2)
+                autoencoder.model_1 = TransformerDoubleAutoencoder(**ae_dict['configuration'], training_level=1)
+                autoencoder.model_1.eval()
+            else:
+                raise ValueError(f"Autoencoder class {ae_dict['configuration']['model_class']} not recognized.")
+        # only states saved from a DDP model have the prefix 'module.' in all keys
+        if next(iter(ae_dict['model']), '').startswith('module.'):
+            consume_prefix_in_state_dict_if_present(ae_dict['model'], 'module.')
+        # the autoencoder is moved to the device afterwards so that its states are only copied once
+        autoencoder.load_state_dict(ae_dict['model'], **assign_kwargs)
+        autoencoder.to(device)
+        del ae_dict
+        # freeze the autoencoder; its forward passes still run with autograd,
+        # since the gradients flow through it to the generator and the gradient penalty
+        autoencoder.requires_grad_(False).eval()
         
         # adjust generator output_dim to match the output_dim of the autoencoder
-        n_channels = autoencoder.output_dim if autoencoder.target in [autoencoder.TARGET_CHANNELS, autoencoder.TARGET_BOTH] else autoencoder.output_dim_2
-        sequence_length_generated = autoencoder.output_dim_2 if autoencoder.target in [autoencoder.TARGET_CHANNELS, autoencoder.TARGET_BOTH] else autoencoder.output_dim
+        encodes_channels = autoencoder.target in (autoencoder.TARGET_CHANNELS, autoencoder.TARGET_BOTH)
+        n_channels = autoencoder.output_dim if encodes_channels else autoencoder.output_dim_2
+        sequence_length_generated = autoencoder.output_dim_2 if encodes_channels else autoencoder.output_dim
 
         # adjust discriminator input_dim to match the output_dim of the autoencoder
         channel_in_disc = n_channels + n_conditions
 
         generator = DecoderGenerator(
-            generator=gan_architectures[gan_types['tts'][0]](
+            generator=build_architecture(gan_types['tts'][0],
                 latent_dim=latent_dim_in,
                 channels=n_channels,
                 seq_len=sequence_length_generated,
                 hidden_dim=hidden_dim,
+                embed_dim=generator_embed_dim,
                 num_layers=num_layers,
-                dropout=0.1,
+                dropout=dropout,
                 activation=activation,
-                num_heads=4,
+                num_heads=num_heads,
 
                 # additional TTSGenerator inputs: patch_size
                 patch_size=patch_size,
@@ -105,13 +143,14 @@ def init_gan(latent_dim_in,
         )
 
         discriminator = EncoderDiscriminator(
-            discriminator=gan_architectures[gan_types['tts'][1]](
+            discriminator=build_architecture(gan_types['tts'][1],
                 channels=channel_in_disc,
                 hidden_dim=hidden_dim,
+                embed_dim=discriminator_embed_dim,
                 num_layers=num_layers,
-                dropout=0.1,
+                dropout=dropout,
                 seq_len=sequence_length_generated,
-                num_heads=4,
+                num_heads=num_heads,
 
                 # additional TTSDiscriminator inputs: patch_size
                 patch_size=patch_size,
@@ -119,12 +158,10 @@ def init_gan(latent_dim_in,
             encoder=autoencoder
         )
 
-        if isinstance(generator, DecoderGenerator) and isinstance(discriminator, EncoderDiscriminator) and input_sequence_length == 0:
-            # if input_sequence_length is 0, do not decode the generator output during training
+        if input_sequence_length == 0:
+            # if input_sequence_length is 0, do not decode the generator output and do not encode the discriminator input
+            # during training; the GAN is trained in the encoded space of the autoencoder
             generator.decode_output(False)
-
-        if isinstance(discriminator, EncoderDiscriminator) and isinstance(generator, DecoderGenerator) and input_sequence_length == 0:
-            # if input_sequence_length is 0, do not encode the discriminator input during training
             discriminator.encode_input(False)
             
     return generator, discriminator
\ No newline at end of file
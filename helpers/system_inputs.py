@@ -112,7 +112,11 @@ class HelperMain(Helper):
             '\n\tOnly if multiple GPUs are available for one node.'
             '\n\tAll available GPUs are used for training.'
             '\n\tEach GPU trains on the whole dataset. '
-            '\n\tHence, the number of training epochs is multiplied by the number of GPUs')
+            '\n\tHence, the number of training epochs is multiplied by the number of GPUs'
+            '\n\tThe distributed training can also be started with torchrun:'
+            '\n\t\ttorchrun --nproc_per_node=<number of GPUs> gan_training_main.py ddp'
+            '\n\tThe backend "gloo" (ddp_backend=gloo) is only used for training on the CPU, where it is also the default.'
+            '\n\tWith GPUs, "nccl" is always used since its all_reduce of large tensors is many times faster.')
         print(
             '3.\tIf you want to load a pre-trained GAN, you can use the following command:'
             '\n\tpython gan_training_main.py load_checkpoint; The default file is "trained_models/checkpoint.pt"'
@@ -258,12 +262,22 @@ class HelperGenerateSamples(Helper):
 def default_inputs_training_gan():
     kw_dict = {
         'ddp': [bool, 'Activate distributed training', False, 'Distributed training is active'],
+        'ddp_backend': [str, 'Backend for distributed training; nccl is always used with GPUs', 'nccl', 'DDP backend: '],
         'seed': [bool, 'Set seed for reproducibility', None, 'Manual seed: '],
         'n_epochs': [int, 'Number of epochs', 100, 'Number of epochs: '],
         'batch_size': [int, 'Batch size', 128, 'Batch size: '],
+        'grad_accum_steps': [int, 'Number of micro-batches per batch for gradient accumulation', 1, 'Gradient accumulation steps: '],
+        'num_workers': [int, 'Number of worker processes for loading batches; 0 is usually fastest', 0, 'Number of workers: '],
+        'amp': [bool, 'Use mixed precision and TF32 for the training on GPUs', False, 'Mixed precision is active'],
+        'compile': [bool, 'Compile the generator and the gradient penalty with torch.compile (PyTorch 2.x only)', False, 'Models are compiled'],
+        'activation_compression': [bool, 'Compress the activations of the discriminator with GACT (requires the package gact)', False, 'Activation compression is active'],
         'sample_interval': [int, 'Interval of epochs between saving samples', 100, 'Sample interval: '],
         'hidden_dim': [int, 'Hidden dimension of the GAN components', 16, 'Hidden dimension: '],
         'num_layers': [int, 'Number of layers of the GAN components', 4, 'Number of layers: '],
+        'num_heads': [int, 'Number of attention heads of the GAN components', 5, 'Number of heads: '],
+        'dropout': [float, 'Dropout rate of the GAN components', 0.5, 'Dropout rate: '],
+        'generator_embed_dim': [int, 'Embedding dimension of the generator; must be a multiple of num_heads', 10, 'Generator embedding dimension: '],
+        'discriminator_embed_dim': [int, 'Embedding dimension of the discriminator; must be a multiple of num_heads', 50, 'Discriminator embedding dimension: '],
         'patch_size': [int, 'Patch size of the divided sequence', 20, 'Patch size: '],
         'discriminator_lr': [float, 'Learning rate for the discriminator', 0.0001, 'Discriminator learning rate: '],
         'generator_lr': [float, 'Learning rate for the generator', 0.0001, 'Generator learning rate: '],
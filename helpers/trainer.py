@@ -1,11 +1,15 @@
 from doctest import debug_script
+import inspect
 import os
 import time
+import warnings
+from contextlib import nullcontext
 from tqdm import tqdm
 from decimal import Decimal
 import numpy as np
 
 import torch
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from torch.nn.modules.utils import consume_prefix_in_state_dict_if_present
 
@@ -14,6 +18,19 @@ from nn_architecture.losses import WassersteinGradientPenaltyLoss as Loss
 from nn_architecture.models import DecoderGenerator, EncoderDiscriminator
 
 
+def adam_optimizer(params, lr, betas):
+    """Adam optimizer with the fastest implementation available: fused for parameters on the gpu, foreach otherwise.
+    Torch versions without these options use the default implementation."""
+    params = list(params)
+    kwargs = {}
+    adam_args = inspect.signature(torch.optim.Adam).parameters
+    if 'fused' in adam_args and all(p.is_cuda for p in params):
+        kwargs['fused'] = True
+    elif 'foreach' in adam_args:
+        kwargs['foreach'] = True
+    return torch.optim.Adam(params, lr=lr, betas=betas, **kwargs)
+
+
 class Trainer:
     def __init__(self):
         pass
@@ -60,6 +77,10 @@ class GANTrainer(Trainer):
         self.n_channels = opt['n_channels'] if 'n_channels' in opt else 1
         self.channel_names = opt['channel_names'] if 'channel_names' in opt else list(range(0, self.n_channels))
         self.b1, self.b2 = 0, 0.9  # alternative values: .5, 0.999
+        self.amp = opt['amp'] if 'amp' in opt else False
+        self.grad_accum_steps = opt['grad_accum_steps'] if 'grad_accum_steps' in opt else 1
+        self.activation_compression = opt['activation_compression'] if 'activation_compression' in opt else False
+        self.compile = opt['compile'] if 'compile' in opt else False
         self.rank = 0  # Device: cuda:0, cuda:1, ... --> Device: cuda:rank
         self.start_time = time.time()
 
@@ -71,21 +92,28 @@ class GANTrainer(Trainer):
 
         self.generator.to(self.device)
         self.discriminator.to(self.device)
+        if self.compile:
+            self.compile_models()
 
-        self.generator_optimizer = torch.optim.Adam(self.generator.parameters(),
-                                                    lr=self.g_lr, betas=(self.b1, self.b2))
-        self.discriminator_optimizer = torch.optim.Adam(self.discriminator.parameters(),
-                                                lr=self.d_lr, betas=(self.b1, self.b2))
+        self.generator_optimizer = adam_optimizer(self.generator.parameters(),
+                                                  lr=self.g_lr, betas=(self.b1, self.b2))
+        self.discriminator_optimizer = adam_optimizer(self.discriminator.parameters(),
+                                                      lr=self.d_lr, betas=(self.b1, self.b2))
 
         self.loss = Loss()
         if isinstance(self.loss, losses.WassersteinGradientPenaltyLoss):
             self.loss.set_lambda_gp(self.lambda_gp)
+            if self.compile:
+                self.loss.compile_penalty()
+
+        self.set_amp()
 
         self.d_losses = []
         self.g_losses = []
         self.trained_epochs = 0
 
         self.prev_g_loss = 0
+        self._latent_buffer = None  # reused generator input; allocated in the first batch on the training device
         generator_class = str(self.generator.__class__.__name__) if not isinstance(self.generator, DecoderGenerator) else str(self.generator.generator.__class__.__name__)
         discriminator_class = str(self.discriminator.__class__.__name__) if not isinstance(self.discriminator, EncoderDiscriminator) else str(self.discriminator.discriminator.__class__.__name__)
         self.configuration = {
@@ -97,6 +125,10 @@ class GANTrainer(Trainer):
             'sequence_length_generated': self.sequence_length_generated,
             'num_layers': opt['num_layers'],
             'hidden_dim': opt['hidden_dim'],
+            'num_heads': opt['num_heads'] if 'num_heads' in opt else 5,
+            'dropout': opt['dropout'] if 'dropout' in opt else 0.5,
+            'generator_embed_dim': opt['generator_embed_dim'] if 'generator_embed_dim' in opt else 10,
+            'discriminator_embed_dim': opt['discriminator_embed_dim'] if 'discriminator_embed_dim' in opt else 50,
             'latent_dim': self.latent_dim,
             'batch_size': self.batch_size,
             'epochs': self.epochs,
@@ -111,6 +143,10 @@ class GANTrainer(Trainer):
             'patch_size': opt['patch_size'] if 'patch_size' in opt else None,
             'b1': self.b1,
             'b2': self.b2,
+            'amp': self.amp,
+            'grad_accum_steps': self.grad_accum_steps,
+            'activation_compression': self.activation_compression,
+            'compile': self.compile,
             'data': opt['data'] if 'data' in opt else None,
             'autoencoder': opt['autoencoder'] if 'autoencoder' in opt else None,
             'n_channels': self.n_channels,
@@ -132,9 +168,10 @@ class GANTrainer(Trainer):
             'history': opt['history'] if 'history' in opt else {},
         }
 
-    def training(self, dataset: DataLoader):
-        """Batch training of the conditional Wasserstein-GAN with GP."""
-        gen_samples = []
+    def training(self, dataset: DataLoader, return_samples=True):
+        """Batch training of the conditional Wasserstein-GAN with GP.
+        If return_samples is False, no generated samples are collected and None is returned."""
+        gen_samples = [] if return_samples else None
         # checkpoint file settings; toggle between two checkpoints to avoid corrupted file if training is interrupted
         path_checkpoint = 'trained_models'
         trigger_checkpoint_01 = True
@@ -144,6 +181,8 @@ class GANTrainer(Trainer):
         gen_samples_batch = None
         batch = None
 
+        self.set_activation_compression()
+
         loop = tqdm(range(self.epochs))
         # try/except for KeyboardInterrupt --> Abort training and save model
         try:
@@ -154,8 +193,9 @@ class GANTrainer(Trainer):
                 g_loss_batch = 0
                 for batch in dataset:
                     # draw batch_size samples from sessions
-                    data = batch[:, self.n_conditions:].to(self.device)
-                    data_labels = batch[:, :self.n_conditions, 0].unsqueeze(1).to(self.device)
+                    # batches from pinned memory are copied asynchronously to overlap the copy with computation
+                    data = batch[:, self.n_conditions:].to(self.device, non_blocking=True)
+                    data_labels = batch[:, :self.n_conditions, 0].unsqueeze(1).to(self.device, non_blocking=True)
 
                     # update generator every n iterations as suggested in paper
                     if i_batch % self.critic_iterations == 0:
@@ -173,7 +213,8 @@ class GANTrainer(Trainer):
 
                 # Save a checkpoint of the trained GAN and the generated samples every sample interval
                 if epoch % self.sample_interval == 0:
-                    gen_samples.append(gen_samples_batch[np.random.randint(0, len(batch))].detach().cpu().numpy())
+                    if return_samples:
+                        gen_samples.append(gen_samples_batch[np.random.randint(0, len(batch))].detach().cpu().numpy())
                     # save models and optimizer states as checkpoints
                     # toggle between checkpoint files to avoid corrupted file during training
                     if trigger_checkpoint_01:
@@ -218,13 +259,17 @@ class GANTrainer(Trainer):
         # if self.generator is instance of EncoderGenerator encode gen_cond_data to speed up training
         if isinstance(self.generator, DecoderGenerator) and self.input_sequence_length != 0:
             gen_cond_data_orig = gen_cond_data
-            gen_cond_data = torch.cat((torch.zeros((batch_size, self.sequence_length - self.input_sequence_length, self.n_channels)).to(self.device), gen_cond_data), dim=1)
+            # zero-pad the front of the sequence on the device of gen_cond_data
+            gen_cond_data = F.pad(gen_cond_data, (0, 0, self.sequence_length - self.input_sequence_length, 0), value=0.0)
             gen_cond_data = self.generator.decoder.decode(gen_cond_data)
 
         seq_length = max(1, gen_cond_data.shape[1])
         gen_labels = torch.cat((gen_cond_data, data_labels.repeat(1, seq_length, 1).to(self.device)), dim=-1).to(self.device) if self.input_sequence_length != 0 else data_labels
         disc_labels = data_labels
 
+        # the backward passes run on micro-batches for gradient accumulation
+        micro_batches = self._micro_batches(batch_size)
+
         # -----------------
         #  Train Generator
         # -----------------
@@ -235,25 +280,34 @@ class GANTrainer(Trainer):
             self.discriminator.eval()
 
             # Sample noise and labels as generator input
-            z = self.sample_latent_variable(batch_size=batch_size, latent_dim=self.latent_dim, sequence_length=seq_length, device=self.device)
-            z = torch.cat((z, gen_labels), dim=-1).to(self.device)
-            z.requires_grad = True
+            z = self._latent_input(gen_labels, batch_size, seq_length)
             
-            # Generate a batch of samples
-            gen_imgs = self.generator(z)
-
-            if gen_cond_data_orig is not None:
-                # gen_cond_data was encoded before; use the original form to make fake data
-                fake_data = self.make_fake_data(gen_imgs, data_labels, gen_cond_data_orig)
-            else:
-                fake_data = self.make_fake_data(gen_imgs, data_labels, gen_cond_data)
-
-            # Compute loss/validity of generated data and update generator
-            validity = self.discriminator(fake_data)
-            g_loss = self.loss.generator(validity)
-            self.generator_optimizer.zero_grad()
-            g_loss.backward()
-            self.generator_optimizer.step()
+            # gen_cond_data was encoded before; use the original form to make fake data
+            cond_data = gen_cond_data_orig if gen_cond_data_orig is not None else gen_cond_data
+
+            self.generator_optimizer.zero_grad(set_to_none=True)
+            g_loss = 0
+            for i, micro_batch in enumerate(micro_batches):
+                # the gradients of the generator are accumulated and only synchronized in the last micro-batch
+                with self._no_sync(self.generator) if i < len(micro_batches) - 1 else nullcontext():
+                    # Generate a batch of samples
+                    with self._autocast():
+                        gen_imgs = self.generator(z[micro_batch]).float()
+                    fake_data = self.make_fake_data(gen_imgs, data_labels[micro_batch], cond_data[micro_batch])
+
+                    # Compute loss/validity of generated data
+                    # the gradients of the discriminator are discarded in this step and do not need to be synchronized
+                    with self._no_sync(self.discriminator):
+                        with self._autocast():
+                            validity = self.discriminator(fake_data)
+                        # weight the loss of the micro-batch by its share of the batch
+                        g_loss_micro = self.loss.generator(validity.float()) * (validity.shape[0] / batch_size)
+                        self.generator_scaler.scale(g_loss_micro).backward()
+                g_loss += g_loss_micro.detach()
+
+            # update generator
+            self.generator_scaler.step(self.generator_optimizer)
+            self.generator_scaler.update()
 
             g_loss = g_loss.item()
             self.prev_g_loss = g_loss
@@ -271,11 +325,11 @@ class GANTrainer(Trainer):
         # Create a batch of generated samples
         with torch.no_grad():
             # Sample noise and labels as generator input
-            z = self.sample_latent_variable(batch_size=batch_size, latent_dim=self.latent_dim, sequence_length=seq_length, device=self.device)
-            z = torch.cat((z, gen_labels), dim=-1).to(self.device)
+            z = self._latent_input(gen_labels, batch_size, seq_length)
 
             # Generate a batch of fake samples
-            gen_imgs = self.generator(z)
+            with self._autocast():
+                gen_imgs = self.generator(z).float()
             if gen_cond_data_orig is not None:
                 # gen_cond_data was encoded before; use the original form to make fake data
                 fake_data = self.make_fake_data(gen_imgs, disc_labels, gen_cond_data_orig)
@@ -318,20 +372,24 @@ class GANTrainer(Trainer):
 
             real_data = self.make_fake_data(real_data, disc_labels)
 
-        # Loss for real and generated samples
-        real_data.requires_grad = True
-        fake_data.requires_grad = True
-        validity_fake = self.discriminator(fake_data)
-        validity_real = self.discriminator(real_data)
-
-        # Total discriminator loss and update
-        if isinstance(self.loss, losses.WassersteinGradientPenaltyLoss):
-            d_loss = self.loss.discriminator(validity_real, validity_fake, self.discriminator, real_data, fake_data)
-        else:
-            d_loss = self.loss.discriminator(validity_real, validity_fake)
-        self.discriminator_optimizer.zero_grad()
-        d_loss.backward()
-        self.discriminator_optimizer.step()
+        self.discriminator_optimizer.zero_grad(set_to_none=True)
+        d_loss = 0
+        for i, micro_batch in enumerate(micro_batches):
+            # the gradients of the discriminator are accumulated and only synchronized in the last micro-batch
+            with self._no_sync(self.discriminator) if i < len(micro_batches) - 1 else nullcontext():
+                real_data_micro = real_data[micro_batch].detach().requires_grad_(True)
+                fake_data_micro = fake_data[micro_batch].detach().requires_grad_(True)
+                # weight the loss of the micro-batch by its share of the batch
+                d_loss_micro = self._discriminator_loss(real_data_micro, fake_data_micro) * (real_data_micro.shape[0] / batch_size)
+                self.discriminator_scaler.scale(d_loss_micro).backward()
+            d_loss += d_loss_micro.detach()
+
+        # update discriminator
+        self.discriminator_scaler.step(self.discriminator_optimizer)
+        self.discriminator_scaler.update()
+
+        if self._gact_controller is not None:
+            self._adapt_activation_compression(real_data_micro, fake_data_micro)
 
         return d_loss.item(), g_loss, gen_samples
 
@@ -359,12 +417,126 @@ class GANTrainer(Trainer):
             'trained_epochs': self.trained_epochs,
             'configuration': self.configuration,
         }
-        torch.save(state_dict, path_checkpoint)
+        self._write_checkpoint(state_dict, path_checkpoint)
 
         if update_history:
             print(f"Checkpoint saved to {path_checkpoint}.")
             print(f"Training complete in: {self.configuration['train_time']}")
 
+    def _write_checkpoint(self, state_dict, path_checkpoint):
+        torch.save(state_dict, path_checkpoint)
+
+    def _discriminator_loss(self, real_data, fake_data):
+        # Loss for real and generated samples
+        with self._autocast(), self._compressed_activations():
+            validity_fake = self.discriminator(fake_data).float()
+            validity_real = self.discriminator(real_data).float()
+
+        # Total discriminator loss
+        # the gradient penalty is computed outside of autocast since its double backward is sensitive to precision;
+        # its activations are not compressed either, since they are also saved for the double backward
+        if isinstance(self.loss, losses.WassersteinGradientPenaltyLoss):
+            return self.loss.discriminator(validity_real, validity_fake, self.discriminator, real_data, fake_data)
+        else:
+            return self.loss.discriminator(validity_real, validity_fake)
+
+    def set_activation_compression(self):
+        """set up GACT for the discriminator if requested to compress the activations saved for its backward pass;
+        GACT is an optional dependency: https://github.com/LiuXiaoxuanPKU/GACT-ICML"""
+        self._gact_controller = None
+        if self.activation_compression:
+            try:
+                import gact
+                from gact.controller import Controller
+            except ImportError:
+                raise ImportError("Activation compressed training requires the package gact. "
+                                  "Please install it or disable 'activation_compression'.")
+            gact.set_optimization_level('L2')
+            # no global hooks are installed; the compression only applies within _compressed_activations
+            self._gact_controller = Controller(self.discriminator.module if hasattr(self.discriminator, 'module') else self.discriminator)
+            # in its adaptive mode GACT estimates the sensitivity of the compression from the gradients of extra backward passes
+            self._gact_adaptive = getattr(gact.config, 'auto_prec', True)
+
+    def _adapt_activation_compression(self, real_data, fake_data):
+        """advance GACT by one iteration after the update of the discriminator.
+        The extra backward passes of the adaptive mode run like the real step, but without synchronizing the gradients
+        across processes; their gradients are discarded afterwards."""
+        if not self._gact_adaptive:
+            self._gact_controller.iterate(None)
+            return
+
+        def backprop():
+            self.discriminator_optimizer.zero_grad(set_to_none=True)
+            with self._no_sync(self.discriminator):
+                self.discriminator_scaler.scale(self._discriminator_loss(real_data, fake_data)).backward()
+        self._gact_controller.iterate(backprop)
+        self.discriminator_optimizer.zero_grad(set_to_none=True)
+
+    def _compressed_activations(self):
+        # context in which the activations saved for the backward pass of the discriminator are compressed by GACT
+        if self._gact_controller is None:
+            return nullcontext()
+        return torch.autograd.graph.saved_tensors_hooks(self._gact_controller.quantize, self._gact_controller.dequantize)
+
+    def _no_sync(self, model):
+        # context in which the gradients of the given model are not synchronized across processes
+        return nullcontext()
+
+    def _micro_batches(self, batch_size):
+        # slices of the batch which are passed backward one after another to accumulate the gradients
+        micro_batch_size = int(np.ceil(batch_size / self.grad_accum_steps))
+        return [slice(i, i + micro_batch_size) for i in range(0, batch_size, micro_batch_size)]
+
+    def _latent_input(self, gen_labels, batch_size, seq_length):
+        """returns the generator input of shape (batch_size, seq_length, latent_dim + n_labels) with new noise.
+        The input is written into a buffer which is allocated once and reused for all batches of the same shape;
+        the generator backward pass is finished before the buffer is overwritten."""
+        shape = (batch_size, seq_length, self.latent_dim + gen_labels.shape[-1])
+        buffer = self._latent_buffer
+        if buffer is None or buffer.device != gen_labels.device or buffer.shape[0] < batch_size or buffer.shape[1:] != shape[1:]:
+            buffer = self._latent_buffer = torch.empty(shape, device=gen_labels.device)
+        z = buffer[:batch_size]
+        with torch.no_grad():
+            z[:, :, :self.latent_dim].normal_()
+            z[:, :, self.latent_dim:].copy_(gen_labels)
+        return z
+
+    def set_amp(self):
+        """set up mixed precision training if requested and the models are on a gpu;
+        bfloat16 is used if supported, otherwise float16 with one gradient scaler per optimizer.
+        The remaining float32 matmuls and convolutions use TF32."""
+        self._use_amp = self.amp and torch.device(self.device).type == 'cuda' and torch.cuda.is_available()
+        if self._use_amp:
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        self.amp_dtype = torch.bfloat16 if self._use_amp and torch.cuda.is_bf16_supported() else torch.float16
+        use_scaler = self._use_amp and self.amp_dtype == torch.float16
+        # torch.cuda.amp.GradScaler is deprecated since PyTorch 2.4 in favor of torch.amp.GradScaler
+        if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+            self.generator_scaler = torch.amp.GradScaler('cuda', enabled=use_scaler)
+            self.discriminator_scaler = torch.amp.GradScaler('cuda', enabled=use_scaler)
+        else:
+            self.generator_scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+            self.discriminator_scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+
+    def compile_models(self):
+        """compile the forward pass of the generator with torch.compile (PyTorch 2.x only).
+        Only the forward method is replaced, so the module and its state_dict keys stay unchanged.
+        A frozen autoencoder is compiled as part of the forward pass of the DecoderGenerator.
+        The discriminator is not compiled, since the gradient penalty needs its double backward pass,
+        which compiled functions do not support.
+        The batches have a static shape if the last incomplete batch is dropped (see tensor_dataloader)."""
+        if not hasattr(torch, 'compile'):
+            warnings.warn("torch.compile is not available in this PyTorch version. The models are not compiled.")
+            return
+        self.generator.forward = torch.compile(self.generator.forward, dynamic=False)
+
+    def _autocast(self):
+        # context in which the forward passes run in mixed precision
+        if not self._use_amp:
+            return nullcontext()
+        return torch.autocast(device_type='cuda', dtype=self.amp_dtype)
+
     def load_checkpoint(self, path_checkpoint):
         if os.path.isfile(path_checkpoint):
             # load state_dicts
@@ -1,5 +1,4 @@
 import warnings
-import numpy as np
 
 import torch
 from torch import autograd
@@ -62,10 +61,21 @@ class WassersteinGradientPenaltyLoss(WassersteinLoss):
     def __init__(self):
         super().__init__(wgan=False)
         self.gradient_penalty_weight = 0
+        self._penalty = _penalty
+        # buffers for the random weights and the interpolated examples; reused for all batches of the same shape
+        self._eta = None
+        self._interpolated = None
 
     def set_lambda_gp(self, lambda_gp):
         self.gradient_penalty_weight = lambda_gp
 
+    def compile_penalty(self):
+        """fuse the pointwise operations of the penalty term into one kernel with torch.compile (PyTorch 2.x only)"""
+        if hasattr(torch, 'compile'):
+            self._penalty = torch.compile(_penalty, dynamic=True)
+        else:
+            warnings.warn("torch.compile is not available in this PyTorch version. The gradient penalty is not compiled.")
+
     def discriminator(self, *args):
         real, fake, discriminator, real_images, fake_images = args
         return super().discriminator(real, fake) + self._gradient_penalty(discriminator, real_images, fake_images)
@@ -88,19 +98,26 @@ class WassersteinGradientPenaltyLoss(WassersteinLoss):
                 raise ValueError("real_images must be of dimension (batch_size, sequence_length, channels)!")
             real_images, fake_images = real_images.permute(0, 3, 2, 1), fake_images.permute(0, 3, 2, 1)
         
-        eta = torch.FloatTensor(np.random.random((real_images.shape[0], 1))).to(real_images.device)#.uniform_(0, 1).repeat((1, real_images.shape[1]))
+        # one random weight per sample, drawn directly on the device of the images
+        batch_size = real_images.shape[0]
+        self._eta = _reusable_buffer(self._eta, (batch_size,) + (1,) * (real_images.dim() - 1), real_images)
+        self._interpolated = _reusable_buffer(self._interpolated, real_images.shape, real_images)
+        eta = self._eta[:batch_size]
+        interpolated = self._interpolated[:batch_size]
 
         # interpolate between real and fake images/labels
         # interpolated_labels = real_labels  # (eta * real_labels + ((1 - eta) * fake_labels))
-        while eta.dim() < real_images.dim():
-            eta = eta.unsqueeze(-1)
-        interpolated = (eta * real_images.detach() + ((1 - eta) * fake_images.detach()))
-        interpolated.requires_grad = True
+        # lerp computes fake + eta * (real - fake) = eta * real + (1 - eta) * fake in a single kernel
+        # the buffers are overwritten in place; the graph of the previous penalty was freed by its backward pass
+        with torch.no_grad():
+            eta.uniform_()
+            torch.lerp(fake_images, real_images, eta, out=interpolated)
+        interpolated = interpolated.detach().requires_grad_(True)
 
         # calculate probability of interpolated examples
         prob_interpolated = discriminator(interpolated)
-        
-        fake = torch.ones((real_images.shape[0], 1), requires_grad=False).to(real_images.device)
+
+        fake = torch.ones_like(prob_interpolated)
 
         # calculate gradients of probabilities with respect to examples
         gradients = autograd.grad(outputs=prob_interpolated,
@@ -108,5 +125,18 @@ class WassersteinGradientPenaltyLoss(WassersteinLoss):
                                   grad_outputs=fake,
                                   create_graph=True,
                                   retain_graph=True)[0]
-        grad_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean() * self.gradient_penalty_weight
-        return grad_penalty
\ No newline at end of file
+        return self._penalty(gradients, self.gradient_penalty_weight)
+
+
+def _reusable_buffer(buffer, shape, like):
+    """returns the given buffer if its first dimension holds the shape and it matches the device and dtype of like;
+    otherwise a new buffer of the shape"""
+    if buffer is None or buffer.shape[0] < shape[0] or buffer.shape[1:] != shape[1:] \
+            or buffer.device != like.device or buffer.dtype != like.dtype:
+        buffer = torch.empty(shape, device=like.device, dtype=like.dtype)
+    return buffer
+
+
+def _penalty(gradients, weight):
+    """penalty term of WGAN-GP for the gradients of the discriminator w.r.t. the interpolated examples"""
+    return ((gradients.norm(2, dim=1) - 1) ** 2).mean() * weight
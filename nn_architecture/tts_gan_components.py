@@ -22,6 +22,7 @@ class Generator(nn.Module):
         self.embed_dim = embed_dim
         self.patch_size = patch_size
         self.depth = depth
+        self.num_heads = num_heads
         self.attn_drop_rate = attn_drop_rate
         self.forward_drop_rate = forward_drop_rate
 
@@ -30,6 +31,7 @@ class Generator(nn.Module):
         self.blocks = Gen_TransformerEncoder(
             depth=self.depth,
             emb_size=self.embed_dim,
+            num_heads=self.num_heads,
             drop_p=self.attn_drop_rate,
             forward_drop_p=self.forward_drop_rate
         )
@@ -44,7 +46,9 @@ class Generator(nn.Module):
         H, W = 1, self.seq_len
         x = self.blocks(x)
         x = x.reshape(x.shape[0], 1, x.shape[1], x.shape[2])
-        output = self.deconv(x.permute(0, 3, 1, 2).contiguous())
+        # the permuted tensor is already laid out channels last; keeping this layout for the 1x1 convolution
+        # saves the copy to NCHW and makes the output contiguous after permuting it back
+        output = self.deconv(x.permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last))
         output = output.squeeze(2).permute(0, 2, 1).contiguous()
         return output
 
@@ -196,9 +200,9 @@ class PatchEmbedding_Linear(nn.Module):
 
 
 class Discriminator(nn.Sequential):
-    def __init__(self, in_channels=3, patch_size=15, emb_size=50, seq_length=150, depth=3, n_classes=1, **kwargs):
+    def __init__(self, in_channels=3, patch_size=15, emb_size=50, seq_length=150, depth=3, n_classes=1, drop_p=0.5, forward_drop_p=0.5, **kwargs):
         super().__init__(
             PatchEmbedding_Linear(in_channels, patch_size, emb_size, seq_length),
-            Dis_TransformerEncoder(depth, emb_size=emb_size, drop_p=0.5, forward_drop_p=0.5, **kwargs),
+            Dis_TransformerEncoder(depth, emb_size=emb_size, drop_p=drop_p, forward_drop_p=forward_drop_p, **kwargs),
             ClassificationHead(emb_size, n_classes)
         )
\ No newline at end of file
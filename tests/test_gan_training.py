@@ -1,6 +1,9 @@
 import sys
 import traceback
 import os
+import importlib.util
+
+import torch
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)))
 from gan_training_main import main
@@ -16,6 +19,7 @@ if __name__ == '__main__':
         '2channels': ["data=data/gansMultiCondition_SHORT.csv", "kw_channel=Electrode", "save_name=gan_2ch.pt"],
         '2channels_1condition': ["sample_interval=1", "data=data/gansMultiCondition_SHORT.csv", "kw_channel=Electrode", "kw_conditions=Condition", "save_name=gan_2ch_1cond.pt"],
         '2channels_2conditions': ["data=data/gansMultiCondition_SHORT.csv", "kw_channel=Electrode", "kw_conditions=Trial,Condition", "save_name=gan_2ch_2cond.pt"],
+        'grad_accum_steps': ["data=data/gansMultiCondition_SHORT.csv", "kw_conditions=Condition", "grad_accum_steps=2", "save_name=gan_grad_accum.pt"],
         
         # configurations for autoencoder GAN
         'autoencoder_basic': ["data=data/gansMultiCondition_SHORT.csv", "autoencoder=trained_ae/ae_gansMultiCondition_SHORT.pt", "kw_channel=Electrode", "save_name=gan_ae.pt"],
@@ -30,6 +34,12 @@ if __name__ == '__main__':
         # 'autoencoder_2conditions_full': ["data=data/gansMultiCondition_SHORT.csv", "autoencoder=trained_ae/ae_gansMultiCondition_SHORT.pt", "kw_channel=Electrode", "kw_conditions=Trial,Condition", "hidden_dim=64", "num_layers=1",],
         # 'load_checkpoint': ["data=data/gansMultiCondition_SHORT.csv", "checkpoint=x", "autoencoder=trained_ae/ae_gansMultiCondition_SHORT.pt", "kw_conditions=Condition", "kw_channel=Electrode"],
     }
+
+    # activation compression requires the optional package gact and a gpu
+    if importlib.util.find_spec('gact') is not None and torch.cuda.is_available():
+        configurations['activation_compression'] = ["data=data/gansMultiCondition_SHORT.csv", "kw_conditions=Condition", "activation_compression", "grad_accum_steps=2", "save_name=gan_gact.pt"]
+    else:
+        print("Skipping configuration activation_compression: the package gact or a gpu is not available.")
     
     # general parameters
     n_epochs = 1